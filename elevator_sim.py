@@ -1,19 +1,28 @@
 import asyncio
 import aiohttp
+import orjson
 import random
 import logging
+import logging.handlers
+import queue
+import atexit
 from datetime import datetime
 import argparse
 import time
 import sys
 
-# Configure logging
+# Configure logging; file writes happen on the listener's thread, off the event loop
+log_queue = queue.SimpleQueue()
+file_log_listener = logging.handlers.QueueListener(log_queue, logging.FileHandler("elevator_simulation.log"))
+file_log_listener.start()
+atexit.register(file_log_listener.stop)
+
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
         logging.StreamHandler(),
-        logging.FileHandler("elevator_simulation.log")
+        logging.handlers.QueueHandler(log_queue)
     ]
 )
 logger = logging.getLogger("ElevatorSim")
@@ -24,147 +33,268 @@ BASE_URL = "http://localhost:8002"  # FastAPI service URL
 DEFAULT_DURATION = 300  # 5 minutes
 DEFAULT_NUM_USERS = 10
 DEFAULT_REQUEST_INTERVAL = (5, 20)  # seconds between requests (min, max)
+PUSH_TIMEOUT = 5  # seconds to wait for a pushed state change before re-checking the cached state
+KEEPALIVE_TIMEOUT = 60  # seconds an idle pooled connection is kept for reuse
+BATCH_INTERVAL = 0.05  # seconds to collect simultaneous calls into one batch
+BATCH_MAX_SIZE = 50  # most calls sent in a single batch request
+
+def random_other_floor(floor):
+    """Pick a floor in 1..MAX_FLOOR other than `floor` with a single draw."""
+    target_floor = random.randrange(1, MAX_FLOOR)
+    return target_floor + 1 if target_floor >= floor else target_floor
+
+# Endpoint URLs, rebuilt by build_urls() whenever BASE_URL changes
+STATUS_URL = ""
+BATCH_URL = ""
+
+def build_urls():
+    """Precompute the endpoint URLs used in the simulation hot path."""
+    global STATUS_URL, BATCH_URL
+    STATUS_URL = f"{BASE_URL}/status"
+    BATCH_URL = f"{BASE_URL}/calls/batch"
+
+build_urls()
+
+class StateStream:
+    """One pushed elevator state stream shared by every simulated user."""
+    
+    def __init__(self, session):
+        self.session = session
+        self.ws = None
+        self.state = None  # Latest elevator status pushed by the service
+        self._events = set()
+        self._reader = None
+    
+    @property
+    def connected(self):
+        return self.ws is not None
+    
+    def subscribe(self):
+        """Return an event that is set on every pushed state change."""
+        event = asyncio.Event()
+        self._events.add(event)
+        return event
+    
+    def _notify(self):
+        for event in self._events:
+            event.set()
+    
+    async def connect(self):
+        """Subscribe to pushed elevator state changes."""
+        try:
+            self.ws = await self.session.ws_connect(f"{BASE_URL}/ws/state")
+            # Seed the cache; changes pushed meanwhile are buffered and applied after it
+            self.state = await self.fetch_status()
+            self._reader = asyncio.create_task(self._read_updates())
+        except Exception as e:
+            logger.warning("Could not open state stream, falling back to polling: %s", e)
+            self.ws = None
+    
+    async def _read_updates(self):
+        """Cache every state change pushed by the service and wake any waiter."""
+        try:
+            async for msg in self.ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    self.state = msg.json(loads=orjson.loads)
+                    self._notify()
+        except Exception as e:
+            logger.warning("State stream failed: %s", e)
+        finally:
+            logger.debug("State stream closed, falling back to polling")
+            self.ws = None
+            self._notify()
+    
+    async def close(self):
+        """Close the state stream if it is open."""
+        if self.ws is not None:
+            await self.ws.close()
+        if self._reader is not None:
+            await asyncio.gather(self._reader, return_exceptions=True)
+            self._reader = None
+    
+    async def fetch_status(self):
+        """Fetch the elevator floor and state from the service."""
+        try:
+            async with self.session.get(STATUS_URL) as response:
+                if response.status == 200:
+                    return orjson.loads(await response.read())
+        except Exception as e:
+            logger.error("Error checking elevator position: %s", e)
+        return None
+
+class CallBatcher:
+    """Coalesces calls from every simulated user into POST /calls/batch requests."""
+    
+    def __init__(self, session):
+        self.session = session
+        self.queue = asyncio.Queue()
+        self._batch = []  # Calls taken off the queue whose batch is not answered yet
+        self._flusher = None
+    
+    def start(self):
+        self._flusher = asyncio.create_task(self._run())
+    
+    async def close(self):
+        # Fail every call still waiting, so no submit() hangs once the flusher is gone
+        while not self.queue.empty():
+            self._batch.append(self.queue.get_nowait())
+        for _, future in self._batch:
+            if not future.done():
+                future.set_result(False)
+        self._batch = []
+        if self._flusher is not None:
+            self._flusher.cancel()
+            await asyncio.gather(self._flusher, return_exceptions=True)
+            self._flusher = None
+    
+    async def submit(self, floor, direction=None):
+        """Queue one call and wait until the batch carrying it is answered."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait(({"floor": floor, "direction": direction}, future))
+        return await future
+    
+    async def _run(self):
+        while True:
+            self._batch = batch = [await self.queue.get()]
+            # Give calls made at about the same time a chance to join this batch
+            await asyncio.sleep(BATCH_INTERVAL)
+            while len(batch) < BATCH_MAX_SIZE and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            
+            ok = await self._send([c for c, _ in batch])
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(ok)
+            self._batch = []
+    
+    async def _send(self, calls):
+        try:
+            async with self.session.post(BATCH_URL, data=orjson.dumps(calls),
+                                         headers={"Content-Type": "application/json"}) as response:
+                if response.status == 200:
+                    logger.debug("Submitted batch of %d calls", len(calls))
+                    return True
+                response_text = await response.text()
+                logger.error("Failed to submit calls: %s - %s", response.status, response_text)
+        except Exception as e:
+            logger.error("Error submitting calls: %s", e)
+        return False
 
 class ElevatorUser:
     """Simulates a person using the elevator system."""
     
-    def __init__(self, user_id, session):
+    def __init__(self, user_id, stream, batcher):
         self.user_id = user_id
-        self.session = session
+        self.stream = stream
+        self.batcher = batcher
         self.current_floor = random.randint(1, MAX_FLOOR)
         self.inside_elevator = False
-        logger.info(f"User {user_id} created at floor {self.current_floor}")
+        self._state_event = stream.subscribe()
+        logger.info("User %s created at floor %s", user_id, self.current_floor)
+    
+    async def current_status(self):
+        """Latest known elevator status, polled only when the state stream is down."""
+        if not self.stream.connected:
+            return await self.stream.fetch_status()
+        return self.stream.state
+    
+    async def wait_for_change(self, timeout):
+        """Wait for the next pushed state change, or poll interval when disconnected."""
+        if not self.stream.connected:
+            await asyncio.sleep(min(timeout, 2))
+            return
+        try:
+            await asyncio.wait_for(self._state_event.wait(), timeout=min(timeout, PUSH_TIMEOUT))
+        except asyncio.TimeoutError:
+            # Nothing pushed for a while, re-check the cached state anyway
+            pass
+        self._state_event.clear()
     
     async def call_elevator(self):
         """Call the elevator from outside."""
-        target_floor = random.randint(1, MAX_FLOOR)
-        
         # Don't go to the same floor
-        while target_floor == self.current_floor:
-            target_floor = random.randint(1, MAX_FLOOR)
+        target_floor = random_other_floor(self.current_floor)
         
         # Determine direction
         direction = "up" if target_floor > self.current_floor else "down"
         
-        logger.info(f"User {self.user_id} at floor {self.current_floor} calling elevator to go {direction}")
+        logger.info("User %s at floor %s calling elevator to go %s", self.user_id, self.current_floor, direction)
         
-        try:
-            # Call elevator from outside
-            url = f"{BASE_URL}/{self.current_floor}/{direction}"
-            async with self.session.post(url) as response:
-                if response.status == 200:
-                    logger.info(f"User {self.user_id} successfully called elevator at floor {self.current_floor}")
-                    return True
-                else:
-                    response_text = await response.text()
-                    logger.error(f"Failed to call elevator: {response.status} - {response_text}")
-                    return False
-                
-        except Exception as e:
-            logger.error(f"Error calling elevator: {str(e)}")
-            return False
+        # Call elevator from outside
+        if await self.batcher.submit(self.current_floor, direction):
+            logger.info("User %s successfully called elevator at floor %s", self.user_id, self.current_floor)
+            return True
+        return False
     
     async def wait_for_elevator(self):
         """Wait for the elevator to arrive at the current floor."""
         max_wait_time = 60  # Maximum wait time in seconds
         wait_start = time.time()
         
-        logger.info(f"User {self.user_id} waiting for elevator at floor {self.current_floor}")
+        logger.info("User %s waiting for elevator at floor %s", self.user_id, self.current_floor)
         
+        self._state_event.clear()
         while time.time() - wait_start < max_wait_time:
-            try:
-                # Check elevator position
-                async with self.session.get(f"{BASE_URL}/floor") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        elevator_floor = data.get("current_floor")
-                        
-                        # Also check state to see if elevator is moving or idle
-                        async with self.session.get(f"{BASE_URL}/state") as state_response:
-                            if state_response.status == 200:
-                                state_data = await state_response.json()
-                                elevator_state = state_data.get("state")
-                                
-                                logger.debug(f"Elevator at floor {elevator_floor}, state: {elevator_state}")
-                                
-                                # If elevator is at our floor and idle or just arrived, enter it
-                                if elevator_floor == self.current_floor and (elevator_state == "idle" or 
-                                                                            time.time() - wait_start > 5):  # Give it time to stop
-                                    logger.info(f"User {self.user_id} entering elevator at floor {self.current_floor}")
-                                    self.inside_elevator = True
-                                    return True
-                    
-            except Exception as e:
-                logger.error(f"Error checking elevator position: {str(e)}")
+            status = await self.current_status()
+            if status:
+                elevator_floor = status.get("current_floor")
+                elevator_state = status.get("state")
+                
+                logger.debug("Elevator at floor %s, state: %s", elevator_floor, elevator_state)
+                
+                # If elevator stopped at our floor and is idle or just arrived, enter it;
+                # a status with a destination means the car is still travelling
+                if elevator_floor == self.current_floor and "destination" not in status and (elevator_state == "idle" or 
+                                                            time.time() - wait_start > 5):  # Give it time to stop
+                    logger.info("User %s entering elevator at floor %s", self.user_id, self.current_floor)
+                    self.inside_elevator = True
+                    return True
             
-            # Wait before checking again
-            await asyncio.sleep(2)
+            # Wait for the next state change
+            await self.wait_for_change(max_wait_time - (time.time() - wait_start))
         
-        logger.warning(f"User {self.user_id} gave up waiting after {max_wait_time} seconds")
+        logger.warning("User %s gave up waiting after %s seconds", self.user_id, max_wait_time)
         return False
     
     async def request_floor(self):
         """Request a floor from inside the elevator."""
-        target_floor = random.randint(1, MAX_FLOOR)
-        
         # Don't request current floor
-        while target_floor == self.current_floor:
-            target_floor = random.randint(1, MAX_FLOOR)
+        target_floor = random_other_floor(self.current_floor)
         
-        logger.info(f"User {self.user_id} inside elevator requesting floor {target_floor}")
+        logger.info("User %s inside elevator requesting floor %s", self.user_id, target_floor)
         
-        try:
-            # Request floor from inside
-            url = f"{BASE_URL}/go/{target_floor}"
-            async with self.session.post(url) as response:
-                if response.status == 200:
-                    logger.info(f"User {self.user_id} successfully requested floor {target_floor}")
-                    return target_floor
-                else:
-                    response_text = await response.text()
-                    logger.error(f"Failed to request floor: {response.status} - {response_text}")
-                    return None
-                
-        except Exception as e:
-            logger.error(f"Error requesting floor: {str(e)}")
-            return None
+        # Request floor from inside
+        if await self.batcher.submit(target_floor):
+            logger.info("User %s successfully requested floor %s", self.user_id, target_floor)
+            return target_floor
+        return None
     
     async def ride_to_floor(self, target_floor):
         """Ride the elevator to the requested floor."""
         max_ride_time = 60  # Maximum ride time in seconds
         ride_start = time.time()
         
-        logger.info(f"User {self.user_id} riding elevator to floor {target_floor}")
+        logger.info("User %s riding elevator to floor %s", self.user_id, target_floor)
         
+        self._state_event.clear()
         while time.time() - ride_start < max_ride_time:
-            try:
-                # Check elevator position
-                async with self.session.get(f"{BASE_URL}/floor") as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        elevator_floor = data.get("current_floor")
-                        
-                        # Also check state
-                        async with self.session.get(f"{BASE_URL}/state") as state_response:
-                            if state_response.status == 200:
-                                state_data = await state_response.json()
-                                elevator_state = state_data.get("state")
-                                
-                                # If elevator reached our floor, exit
-                                if elevator_floor == target_floor and (elevator_state == "idle" or 
-                                                                     time.time() - ride_start > 5):  # Give it time to stop
-                                    logger.info(f"User {self.user_id} exiting elevator at floor {target_floor}")
-                                    self.current_floor = target_floor
-                                    self.inside_elevator = False
-                                    return True
-                    
-            except Exception as e:
-                logger.error(f"Error checking elevator position: {str(e)}")
+            status = await self.current_status()
+            if status:
+                elevator_floor = status.get("current_floor")
+                elevator_state = status.get("state")
+                
+                # If elevator stopped at our floor, exit
+                if elevator_floor == target_floor and "destination" not in status and (elevator_state == "idle" or 
+                                                     time.time() - ride_start > 5):  # Give it time to stop
+                    logger.info("User %s exiting elevator at floor %s", self.user_id, target_floor)
+                    self.current_floor = target_floor
+                    self.inside_elevator = False
+                    return True
             
-            # Wait before checking again
-            await asyncio.sleep(2)
+            # Wait for the next state change
+            await self.wait_for_change(max_ride_time - (time.time() - ride_start))
         
-        logger.warning(f"User {self.user_id} ride timed out after {max_ride_time} seconds")
+        logger.warning("User %s ride timed out after %s seconds", self.user_id, max_ride_time)
         # Assume we got to the floor anyway to continue simulation
         self.current_floor = target_floor
         self.inside_elevator = False
@@ -182,71 +312,93 @@ class ElevatorUser:
                     # Ride to the requested floor
                     await self.ride_to_floor(target_floor)
 
-async def check_service_status():
+async def check_service_status(session):
     """Check if the elevator service is running."""
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"{BASE_URL}/simulation/status") as response:
-                if response.status == 200:
-                    data = await response.json()
-                    return data.get("running", False)
+        async with session.get(f"{BASE_URL}/simulation/status") as response:
+            if response.status == 200:
+                data = orjson.loads(await response.read())
+                return data.get("running", False)
     except Exception:
         return False
     return False
 
-async def ensure_service_running():
+async def ensure_service_running(session):
     """Make sure the elevator simulation is running."""
-    is_running = await check_service_status()
+    is_running = await check_service_status(session)
     
     if not is_running:
         logger.info("Starting elevator service simulation...")
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(f"{BASE_URL}/simulation/start") as response:
-                    if response.status == 200:
-                        logger.info("Elevator service simulation started successfully")
-                    else:
-                        response_text = await response.text()
-                        logger.warning(f"Failed to start elevator service: {response.status} - {response_text}")
+            async with session.post(f"{BASE_URL}/simulation/start") as response:
+                if response.status == 200:
+                    logger.info("Elevator service simulation started successfully")
+                else:
+                    response_text = await response.text()
+                    logger.warning("Failed to start elevator service: %s - %s", response.status, response_text)
         except Exception as e:
-            logger.error(f"Error starting elevator service: {str(e)}")
+            logger.error("Error starting elevator service: %s", e)
             logger.error("Make sure the elevator service is running on the specified URL")
             return False
     
     return True
 
-async def simulate_user(user_id, duration, request_interval):
+async def simulate_user(user_id, duration, request_interval, stream, batcher):
     """Simulate a user making multiple elevator requests over time."""
-    async with aiohttp.ClientSession() as session:
-        user = ElevatorUser(user_id, session)
-        
-        end_time = time.time() + duration
+    user = ElevatorUser(user_id, stream, batcher)
+    
+    end_time = time.time() + duration
+    
+    while time.time() < end_time:
+        # Complete one full usage cycle
+        await user.simulate_usage()
         
-        while time.time() < end_time:
-            # Complete one full usage cycle
-            await user.simulate_usage()
-            
-            # Random wait before next request
-            wait_time = random.uniform(request_interval[0], request_interval[1])
-            logger.info(f"User {user_id} waiting {wait_time:.1f} seconds before next request")
-            await asyncio.sleep(wait_time)
+        # Random wait before next request
+        wait_time = random.uniform(request_interval[0], request_interval[1])
+        logger.info("User %s waiting %.1f seconds before next request", user_id, wait_time)
+        await asyncio.sleep(wait_time)
 
 async def run_simulation(num_users, duration, request_interval):
     """Run the complete elevator simulation with multiple users."""
-    logger.info(f"Starting elevator simulation with {num_users} users for {duration} seconds")
-    
-    # Make sure the elevator service is running
-    if not await ensure_service_running():
-        logger.error("Cannot start simulation without elevator service running")
-        return
+    logger.info("Starting elevator simulation with %s users for %s seconds", num_users, duration)
     
-    # Create user tasks
-    user_tasks = []
-    for i in range(1, num_users + 1):
-        user_tasks.append(simulate_user(i, duration, request_interval))
-    
-    # Run all users concurrently
-    await asyncio.gather(*user_tasks)
+    # One session (and connection pool) behind the stream and batcher every user shares.
+    # No connection cap, cached DNS, and idle sockets kept open across the
+    # pauses between user requests so they are reused, not reopened.
+    connector = aiohttp.TCPConnector(
+        limit=0,
+        limit_per_host=0,
+        use_dns_cache=True,
+        ttl_dns_cache=300,
+        force_close=False,
+        keepalive_timeout=KEEPALIVE_TIMEOUT,
+    )
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # Make sure the elevator service is running
+        if not await ensure_service_running(session):
+            logger.error("Cannot start simulation without elevator service running")
+            return
+        
+        # Every user shares one state stream instead of holding its own socket
+        stream = StateStream(session)
+        await stream.connect()
+        
+        # Calls from all users are coalesced into batch requests
+        batcher = CallBatcher(session)
+        batcher.start()
+        
+        # Create user tasks
+        user_tasks = []
+        for i in range(1, num_users + 1):
+            user_tasks.append(simulate_user(i, duration, request_interval, stream, batcher))
+        
+        try:
+            # Run all users concurrently
+            await asyncio.gather(*user_tasks)
+        finally:
+            await batcher.close()
+            await stream.close()
     
     logger.info("Elevator simulation completed")
 
@@ -277,6 +429,7 @@ def main():
     
     # Update global settings
     BASE_URL = args.url
+    build_urls()
     
     # Configure request interval
     request_interval = (args.min_interval, args.max_interval)
@@ -288,7 +441,7 @@ def main():
         logger.info("Simulation interrupted by user")
         sys.exit(0)
     except Exception as e:
-        logger.error(f"Simulation error: {str(e)}")
+        logger.error("Simulation error: %s", e)
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -1,61 +1,178 @@
 import asyncio
-from fastapi import BackgroundTasks, FastAPI, HTTPException
+from typing import List, Literal, Optional
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
 import logging
-from service import get_current_floor, get_current_state, call, go_to
+import logging.handlers
+import queue
+import atexit
+import orjson
+from service import (
+    STATE_CHANNEL, redis_client, get_current_state, call, call_batch, go_to, wait_for_work,
+    requeue_floor, floor_in_transit
+)
 from contextlib import asynccontextmanager
 
-# Configure logging
+# Configure logging; file writes happen on the listener's thread, off the event loop
+log_queue = queue.SimpleQueue()
+file_log_listener = logging.handlers.QueueListener(log_queue, logging.FileHandler("elevator_system.log"))
+file_log_listener.start()
+atexit.register(file_log_listener.stop)
+
 logging.basicConfig(level=logging.INFO, 
                     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     handlers=[
         logging.StreamHandler(),  # Log to console
-        logging.FileHandler("elevator_system.log")  # Also log to a file
+        logging.handlers.QueueHandler(log_queue)  # Also log to a file
     ]
                     
 )
 logger = logging.getLogger(__name__)
 
-service_logger = logging.getLogger("service")
-service_logger.setLevel(logging.INFO)
-
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup code
     logger.info("Elevator service is starting up")
-    background_tasks = BackgroundTasks()
-    await start_simulation(background_tasks)
+    app.state.state_task = asyncio.create_task(track_state())
+    await start_simulation_task(app)
     
-    yield  # This is where the app runs
-    
-    # Shutdown code
-    logger.info("Elevator service is shutting down")
-    global simulation_running
-    simulation_running = False
+    try:
+        yield  # This is where the app runs
+    finally:
+        # Shutdown code
+        logger.info("Elevator service is shutting down")
+        stop_simulation_loop()
+        tasks = (app.state.sim_task, app.state.state_task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 app = FastAPI(title="Elevator Control System", 
               description="API for controlling an elevator system",
+              default_response_class=ORJSONResponse,
               lifespan=lifespan
               )
 
 simulation_running = False
+simulation_generation = 0  # Bumped on every stop; a loop only keeps going while its generation is current
+simulation_parked = False  # True while the loop is blocked waiting for a call
 MAX_FLOOR = 20  # Define a constant
+MAX_LONG_POLL = 30  # Upper bound in seconds for held /floor requests
+
+# Elevator state mirrored from the elevator.state channel, so reads never hit Redis.
+# While a trip is in progress "floor" is the origin and the floor in transit is
+# worked out from "destination" and "departed_at" when it is read.
+state_cache = {"floor": 1, "state": "idle", "destination": None, "departed_at": None}
+# Revision of the reported position, used by long-polling clients
+floor_revision = 0
+floor_changed = asyncio.Event()
+
+def update_state_cache(floor, state, destination=None, departed_at=None):
+    """Store the latest elevator state and wake long-polls if the car arrived or left."""
+    global floor_revision, floor_changed
+    floor = int(floor)
+    destination = int(destination) if destination is not None else None
+    moved = floor != state_cache["floor"] or destination != state_cache["destination"]
+    state_cache["floor"] = floor
+    state_cache["state"] = state
+    state_cache["destination"] = destination
+    state_cache["departed_at"] = float(departed_at) if destination is not None else None
+    if moved:
+        floor_revision += 1
+        floor_changed.set()
+        floor_changed = asyncio.Event()
+
+def cached_floor():
+    """Floor the car is at, or has just passed while travelling."""
+    if state_cache["destination"] is None:
+        return state_cache["floor"]
+    return floor_in_transit(state_cache["floor"], state_cache["destination"], state_cache["departed_at"])
+
+async def wait_for_floor_change(since, timeout):
+    """Wait until the floor revision differs from `since` or `timeout` expires."""
+    if floor_revision == since:
+        try:
+            await asyncio.wait_for(floor_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+    return floor_revision
+
+async def track_state():
+    """Keep state_cache in sync with the elevator.state channel."""
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(STATE_CHANNEL)
+            # Seed after subscribing so no change is missed in between
+            state = await get_current_state()
+            update_state_cache(state["floor"], state["state"], state.get("destination"), state.get("departed_at"))
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    data = orjson.loads(message["data"])
+                    update_state_cache(data["current_floor"], data["state"], data.get("destination"), data.get("departed_at"))
+        except Exception as e:
+            logger.error("Error tracking elevator state: %s", e)
+            await asyncio.sleep(1)  # Back off before resubscribing
+        finally:
+            await pubsub.aclose()
 
 # In main.py, update the simulation loop for faster checks:
-async def run_elevator_simulation():
-    global simulation_running
+async def run_elevator_simulation(generation, after=None):
+    global simulation_running, simulation_parked
+    if after is not None:
+        # A stopped loop is still finishing its trip; only one loop drives the car
+        await asyncio.gather(after, return_exceptions=True)
     logger.info("Starting elevator simulation background task")
-    simulation_running = True
     try:
-        while simulation_running:  # Exit loop when flag is False
-            await go_to()
-            await asyncio.sleep(0.5)  # Reduced sleep time
+        while simulation_generation == generation:  # Exit loop once stopped
+            if await go_to():
+                await asyncio.sleep(0)  # Yield to the request handlers between trips
+                continue
+            if simulation_generation != generation:
+                break  # Stopped while checking for work; don't park
+            # Nothing to do: block in Redis until a floor is queued, then serve it
+            simulation_parked = True
+            try:
+                work = await wait_for_work()
+            finally:
+                simulation_parked = False
+            if not work:
+                continue
+            if simulation_generation != generation:
+                # Stopped while parked; leave the call for the next loop
+                await requeue_floor(*work)
+                break
+            await go_to(work)  # puts the floor back itself if the trip fails
     except Exception as e:
-        logger.error(f"Error in elevator simulation loop: {str(e)}")
+        logger.error("Error in elevator simulation loop: %s", e)
     finally:
-        simulation_running = False
+        if simulation_generation == generation:
+            simulation_running = False
         
 
+async def start_simulation_task(app: FastAPI):
+    """Schedule the simulation loop on the running event loop and keep a handle on it."""
+    global simulation_running
+    # A stopped loop may still be running; don't run two
+    previous = getattr(app.state, "sim_task", None)
+    if previous is not None and previous.done():
+        previous = None
+    elif previous is not None and simulation_parked:
+        # A loop parked waiting for a call has no trip to finish
+        previous.cancel()
+    # One still mid-trip finishes it first; the new loop starts once it exits
+    simulation_running = True
+    app.state.sim_task = asyncio.create_task(run_elevator_simulation(simulation_generation, after=previous))
+    return app.state.sim_task
+
+def stop_simulation_loop():
+    """Tell the running loop to exit once it has finished its current trip."""
+    global simulation_running, simulation_generation
+    simulation_running = False
+    simulation_generation += 1
+
 # from the outside of the elevator
 @app.get("/")
 def read_root():
@@ -64,22 +181,67 @@ def read_root():
 @app.get("/state")
 async def get_state():
     """Get the current state of the elevator."""
-    try:
-        state = await get_current_state()
-        return state
-    except Exception as e:
-        logger.error(f"Error getting elevator state: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to get elevator state: {str(e)}")
+    return {"floor": cached_floor(), "state": state_cache["state"]}
 
 @app.get("/floor")
-async def current_floor():
-    """Get the current floor of the elevator."""
+async def current_floor(since: Optional[int] = None, wait: float = MAX_LONG_POLL):
+    """Get the current floor of the elevator.
+
+    When `since` is given the request is held until the floor revision moves
+    past it, or until `wait` seconds have passed.
+    """
+    revision = floor_revision
+    if since is not None:
+        revision = await wait_for_floor_change(since, min(max(wait, 0), MAX_LONG_POLL))
+    return {"current_floor": cached_floor(), "rev": revision}
+
+@app.get("/status")
+async def status():
+    """Get the current floor and state of the elevator in one response.
+
+    While the car is travelling the response also carries its `destination`.
+    """
+    status = {"current_floor": cached_floor(), "state": state_cache["state"]}
+    if state_cache["destination"] is not None:
+        status["destination"] = state_cache["destination"]
+    return status
+
+async def forward_state(pubsub, websocket: WebSocket):
+    """Send every message on the state channel to the client."""
+    async for message in pubsub.listen():
+        if message["type"] == "message":
+            await websocket.send_text(message["data"])
+
+async def wait_for_disconnect(websocket: WebSocket):
+    """Return once the client goes away; anything it sends is ignored."""
+    while (await websocket.receive())["type"] != "websocket.disconnect":
+        pass
+
+@app.websocket("/ws/state")
+async def state_updates(websocket: WebSocket):
+    """Push every elevator floor/state change to the client."""
+    await websocket.accept()
+    pubsub = redis_client.pubsub()
     try:
-        floor = await get_current_floor()
-        return {"current_floor": floor}
-    except Exception as e:
-        logger.error(f"Error getting current floor: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Failed to get current floor: {str(e)}")
+        await pubsub.subscribe(STATE_CHANNEL)
+        # Watch the socket as well, so a client leaving while the elevator is idle
+        # releases its subscription right away instead of on the next send
+        tasks = (
+            asyncio.create_task(forward_state(pubsub, websocket)),
+            asyncio.create_task(wait_for_disconnect(websocket)),
+        )
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception) and not isinstance(result, WebSocketDisconnect):
+                logger.error("Error streaming elevator state: %s", result)
+        logger.debug("State subscriber disconnected")
+    finally:
+        await pubsub.aclose()
 
 
 # from the inside of the elevator
@@ -101,7 +263,7 @@ async def go_to_floor(floor: int):
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error processing go_to request: {str(e)}")
+        logger.error("Error processing go_to request: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to process request: {str(e)}")
 
 #from the outside of the elevator
@@ -119,7 +281,7 @@ async def go_up(floor: int):
             "direction": "up"
         }
     except Exception as e:
-        logger.error(f"Error processing up call request: {str(e)}")
+        logger.error("Error processing up call request: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to process request: {str(e)}")
 
 @app.post("/{floor}/down")
@@ -136,17 +298,42 @@ async def go_down(floor: int):
             "direction": "down"
         }
     except Exception as e:
-        logger.error(f"Error processing down call request: {str(e)}")
+        logger.error("Error processing down call request: %s", e)
         raise HTTPException(status_code=500, detail=f"Failed to process request: {str(e)}")
+
+class CallIn(BaseModel):
+    floor: int
+    direction: Optional[Literal["up", "down"]] = None  # None for a call from inside the elevator
+
+@app.post("/calls/batch")
+async def batch_calls(calls: List[CallIn]):
+    """Submit several inside and/or outside calls in one request."""
+    try:
+        for c in calls:
+            if c.floor > MAX_FLOOR or c.floor < 1:
+                raise HTTPException(status_code=400, detail=f"Floor must be between 1 and {MAX_FLOOR}")
+        
+        queued = await call_batch([(c.floor, c.direction) for c in calls])
+        return {
+            "message": "Requests submitted successfully",
+            "received": len(calls),
+            "queued": queued
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error processing batch call request: %s", e)
+        raise HTTPException(status_code=500, detail=f"Failed to process request: {str(e)}")
+
 @app.post("/simulation/start")
-async def start_simulation(background_tasks: BackgroundTasks):
+async def start_simulation():
     """Start the elevator simulation."""
     global simulation_running
     
     if simulation_running:
         return {"message": "Simulation is already running"}
     
-    background_tasks.add_task(run_elevator_simulation)
+    await start_simulation_task(app)
     return {"message": "Elevator simulation started"}
 
 @app.post("/simulation/stop")
@@ -157,7 +344,7 @@ async def stop_simulation():
     if not simulation_running:
         return {"message": "Simulation is not running"}
     
-    simulation_running = False
+    stop_simulation_loop()
     return {"message": "Elevator simulation stopping..."}
 
 @app.get("/simulation/status")
@@ -170,4 +357,5 @@ if __name__ == "__main__":
     import uvicorn
     logger.info("Starting elevator service...")
 
-    uvicorn.run("main:app", host="0.0.0.0", port=8002, reload=True)
\ No newline at end of file
+    # Outlive the simulator's 60 s client keep-alive so pooled connections are reused
+    uvicorn.run("main:app", host="0.0.0.0", port=8002, reload=True, timeout_keep_alive=75)
\ No newline at end of file
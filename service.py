@@ -1,12 +1,34 @@
 import asyncio
-import aioredis
+from dataclasses import dataclass
+import time
+import orjson
+from redis.asyncio import Redis
 import logging
 
 logger = logging.getLogger(__name__)
 # Connect to Redis 
-once = 0
 
-redis_client = aioredis.from_url('redis://localhost:6379')
+REDIS_URL = 'redis://localhost:6379'
+redis_client = Redis.from_url(REDIS_URL, decode_responses=True, health_check_interval=30)
+
+# Seconds an idle elevator blocks waiting for a queued floor before re-checking
+IDLE_TIMEOUT = 30
+# The blocking pop gets its own client whose read timeout outlasts it; the shared
+# client keeps redis-py's short default for every request-path command
+blocking_client = Redis.from_url(REDIS_URL, decode_responses=True, health_check_interval=30,
+                                 socket_timeout=IDLE_TIMEOUT + 5)
+
+# Pub/Sub channel that receives every elevator state change
+STATE_CHANNEL = 'elevator.state'
+
+@dataclass
+class ElevatorState:
+    """In-process elevator flags shared by call() and go_to(); floor and direction live in Redis."""
+    stopped_logged: bool = False
+
+elevator_state = ElevatorState()
+# Guards ElevatorState; only ever held for in-memory updates, never across Redis I/O
+state_lock = asyncio.Lock()
 
 # get current state
 # async def get_current_state():
@@ -21,15 +43,16 @@ redis_client = aioredis.from_url('redis://localhost:6379')
 #     return {key.decode(): value.decode() for key, value in state.items()}
 async def get_current_state():
     try:
-        # Check if the key exists and what type it is
-        key_type = await redis_client.type('state')
+        # Check the key type and read it in a single round trip
+        async with redis_client.pipeline(transaction=False) as pipe:
+            key_type, state = await pipe.type('state').hgetall('state').execute(raise_on_error=False)
         
-        # If the key exists but is not a hash, delete it
-        if key_type and key_type != b'hash':
-            logging.warning(f"'state' key exists but is of type {key_type.decode()}, deleting it")
+        # If the key exists but is not a hash, delete it (TYPE reports 'none' when it is missing)
+        if key_type not in ('hash', 'none'):
+            logger.warning("'state' key exists but is of type %s, deleting it", key_type)
             await redis_client.delete('state')
+            state = None
             
-        state = await redis_client.hgetall('state')
         if not state:
             state = {
                 "floor": 1,
@@ -37,52 +60,100 @@ async def get_current_state():
             }
             await set_current_state(state)
             return state
-        return {key.decode(): value.decode() for key, value in state.items()}
+        return state
     except Exception as e:
-        import traceback
-        error_location = traceback.extract_tb(e.__traceback__)[-1]
-        file_name = error_location.filename.split('/')[-1]
-        line_number = error_location.lineno
-        logging.error(f"Error in get_current_state at {file_name}:{line_number}: {e}")
-        logging.debug(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error in get_current_state: %s", e)
         # Return default state in case of error
         return {"floor": 1, "state": "idle"}
     
 # set the current state
 async def set_current_state(state):
-    await redis_client.hmset('state', state)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hset('state', mapping=state)
+        pipe.hdel('state', 'destination', 'departed_at')  # not moving
+        pipe.publish(STATE_CHANNEL, orjson.dumps({
+            "current_floor": int(state["floor"]),
+            "state": state["state"]
+        }))
+        await pipe.execute()
+
+def floor_in_transit(origin, destination, departed_at, now=None):
+    """Floor a car that left `origin` for `destination` at `departed_at` is at or has just passed."""
+    travelled = int((now or time.time()) - departed_at)  # one floor per second
+    if destination > origin:
+        return min(origin + travelled, destination)
+    return max(origin - travelled, destination)
+
+# Get the current floor and, while a trip is in progress, the direction it is heading
+async def get_current_position():
+    async with redis_client.pipeline(transaction=False) as pipe:
+        current_floor, (destination, departed_at) = await pipe.get('current_floor').hmget('state', 'destination', 'departed_at').execute()
+    current_floor = int(current_floor) if current_floor else 1
+    if destination is None or departed_at is None:
+        return current_floor, None
+    destination = int(destination)
+    heading = "up" if destination > current_floor else "down"
+    return floor_in_transit(current_floor, destination, float(departed_at)), heading
 
 # Get the current floor
 async def get_current_floor():
-    current_floor = await redis_client.get('current_floor')
-    return int(current_floor) if current_floor else 1
+    current_floor, _ = await get_current_position()
+    return current_floor
 
 # Set the current floor
 async def set_current_floor(floor):
     await redis_client.set('current_floor', floor)
 
-async def add_floor(direction, floor):
-    await redis_client.zadd(direction, {f'floor_{floor}': floor})
+# Set the current floor and state together in one round trip.
+# A departure also records where the car is going and when it left, so readers
+# can work out the floor in transit instead of seeing the origin for the whole trip.
+async def set_current_position(floor, state, destination=None, departed_at=None):
+    message = {"current_floor": int(floor), "state": state}
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.set('current_floor', floor)
+        if destination is None:
+            pipe.hset('state', mapping={"floor": floor, "state": state})
+            pipe.hdel('state', 'destination', 'departed_at')
+        else:
+            pipe.hset('state', mapping={"floor": floor, "state": state,
+                                        "destination": destination, "departed_at": departed_at})
+            message.update(destination=int(destination), departed_at=departed_at)
+        pipe.publish(STATE_CHANNEL, orjson.dumps(message))
+        await pipe.execute()
+
+# Block until a floor is queued in either direction, popping it; None after IDLE_TIMEOUT seconds
+async def wait_for_work():
+    return await blocking_client.bzpopmin(['up', 'down'], timeout=IDLE_TIMEOUT)
+
+# Put back a floor popped by wait_for_work that was not served
+async def requeue_floor(queue, floor, score):
+    await redis_client.zadd(queue, {floor: score})
 
 # Inside the elevator operation
 
+# Atomically peek at the nearest queued floor in the direction of travel and remove it
+POP_NEXT_UP = redis_client.register_script("""
+local v = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], '+inf', 'LIMIT', 0, 1)
+if #v == 0 then return nil end
+redis.call('ZREM', KEYS[1], v[1])
+return v[1]
+""")
+POP_NEXT_DOWN = redis_client.register_script("""
+local v = redis.call('ZREVRANGEBYSCORE', KEYS[1], ARGV[1], '-inf', 'LIMIT', 0, 1)
+if #v == 0 then return nil end
+redis.call('ZREM', KEYS[1], v[1])
+return v[1]
+""")
+
 async def get_next_floor(direction, current_floor):
     if direction == 'up':
-        next_floors = await redis_client.zrangebyscore(
-            direction, current_floor, float('inf'), start=0, num=1, withscores=True
-        )
+        next_floor = await POP_NEXT_UP(keys=[direction], args=[current_floor])
     elif direction == 'down':
-        next_floors = await redis_client.zrevrangebyscore(
-            direction, current_floor, 0, start=0, num=1, withscores=True
-        )
+        next_floor = await POP_NEXT_DOWN(keys=[direction], args=[current_floor])
     else:
         return None
 
-    if next_floors:
-        next_floor = next_floors[0][0].decode()
-        await redis_client.zrem(direction, next_floor)
-        return next_floor
-    return None
+    return next_floor
 
 
 # async def set_go_to(floor, direction=""):
@@ -98,50 +169,69 @@ async def get_next_floor(direction, current_floor):
 #     else:
 #         await redis_client.lpush("down", floor)
 
-# call from outside
-async def call(floor, direction=None):
-    global once
-    once = 0
-    try:
-        current_floor = await get_current_floor()
+def pick_queue(floor, current_floor, heading=None):
+    """Queue that takes the car from `current_floor` to `floor`, or None if it is standing there."""
+    if floor > current_floor:
+        return "up"
+    if floor < current_floor:
+        return "down"
+    if heading:
+        # The car has already left this floor, so it is behind the trip in progress
+        return "down" if heading == "up" else "up"
+    return None
 
-        if direction: # from outside the elevator
-            logger.info(f"External call from floor {floor} from floor {current_floor}, direction {direction}")
-            
-            if floor > current_floor:
-                pickup_queue = "up"
-            elif floor < current_floor:
-                pickup_queue = "down"
-            else:
-                logger.info("Already at floor")
-            # Add to pickup queue (up/down)
-            await add_floor(pickup_queue, floor)
-            
-            # Store intended direction for post-pickup (e.g., "up")
-            await redis_client.hset(f"floor_{floor}", "intended_direction", direction)
+def queue_call(pipe, floor, direction, current_floor, heading=None):
+    """Add the Redis commands for one call to `pipe`; returns False if nothing needs queuing.
 
-        else: # when the call is from inside the elevator
-            logger.info(f"Internal call to floor {floor} from floor {current_floor}")
+    `heading` is the direction of a trip in progress, if any.
+    """
+    queue = pick_queue(floor, current_floor, heading)
+    if direction: # from outside the elevator
+        logger.info("External call from floor %s from floor %s, direction %s", floor, current_floor, direction)
+        
+        if queue is None:
+            logger.info("Already at floor")
+            return False
+        # Add to pickup queue (up/down) and store intended direction
+        # for post-pickup (e.g., "up")
+        pipe.zadd(queue, {f'floor_{floor}': floor})
+        pipe.hset(f"floor_{floor}", "intended_direction", direction)
+
+    else: # when the call is from inside the elevator
+        logger.info("Internal call to floor %s from floor %s", floor, current_floor)
+
+        if queue is None:
+            logger.info("Already at the requested floor %s", floor)
+            return False
+        pipe.zadd(queue, {f'floor_{floor}': floor})
+    return True
 
-            if current_floor == floor:
-                logger.info(f"Already at the requested floor {floor}")
-                return "Already at the requested floor"
-            elif current_floor < floor:
-                await add_floor("up", floor)
-            else:
-                await add_floor("down", floor)
+# call from outside
+async def call(floor, direction=None, state=elevator_state):
+    if not await call_batch([(floor, direction)], state) and not direction:
+        return "Already at the requested floor"
+
+# several calls at once, from inside and/or outside
+async def call_batch(calls, state=elevator_state):
+    async with state_lock:
+        state.stopped_logged = False
+    try:
+        current_floor, heading = await get_current_position()
+
+        # Queue every call in one round trip
+        async with redis_client.pipeline(transaction=False) as pipe:
+            queued = sum(queue_call(pipe, floor, direction, current_floor, heading) for floor, direction in calls)
+            if queued:
+                await pipe.execute()
         # Log the current state of the queues for debugging
-        up_queue = await redis_client.zrange("up", 0, -1, withscores=True)
-        down_queue = await redis_client.zrange("down", 0, -1, withscores=True)
-        logger.debug(f"Current up queue: {up_queue}")
-        logger.debug(f"Current down queue: {down_queue}")
+        if logger.isEnabledFor(logging.DEBUG):
+            async with redis_client.pipeline(transaction=False) as pipe:
+                up_queue, down_queue = await pipe.zrange("up", 0, -1, withscores=True).zrange("down", 0, -1, withscores=True).execute()
+            logger.debug("Current up queue: %s", up_queue)
+            logger.debug("Current down queue: %s", down_queue)
+        return queued
     except Exception as e:
-        import traceback
-        error_location = traceback.extract_tb(e.__traceback__)[-1]
-        file_name = error_location.filename.split('/')[-1]
-        line_number = error_location.lineno
-        logger.error(f"Error in call function at {file_name}:{line_number}: {e}")
-        logger.debug(f"Full traceback: {traceback.format_exc()}")
+        logger.exception("Error in call_batch function: %s", e)
         raise e
 
     # Get the list of floors to go to
@@ -159,8 +249,10 @@ async def call(floor, direction=None):
 # Get all queues (both up and down) as sorted lists
 
 #simulate go to floor...
-async def go_to():
-    global once
+# Returns True if the elevator served a floor, False if there was nothing to do.
+# `pending` is a (queue, member, score) entry the caller already popped, served as is.
+# A floor popped here or by the caller is put back if the trip fails or is cancelled.
+async def go_to(pending=None, state=elevator_state):
     try:
 
         current_state = await get_current_state()
@@ -168,18 +260,26 @@ async def go_to():
         current_direction = current_state["state"]
 
         next_floor = None
+        next_queue = current_direction  # queue next_floor was popped from
         new_direction = current_direction
 
-        if current_direction == "up":
+        if pending:
+            next_queue, next_floor, _ = pending
+            pending_number = int(next_floor.split("_")[1])
+            if pending_number > current_floor:
+                new_direction = "up"
+            elif pending_number < current_floor:
+                new_direction = "down"
+        elif current_direction == "up":
             next_floor = await get_next_floor("up", current_floor)
             if not next_floor:
                 next_floor = await get_next_floor("down", current_floor)
-                new_direction = "down" if next_floor else "idle" #
+                next_queue = new_direction = "down" if next_floor else "idle" #
         elif current_direction == "down":
             next_floor = await get_next_floor("down", current_floor)
             if not next_floor:
                 next_floor = await get_next_floor("up", current_floor)
-                new_direction = "up" if next_floor else "idle" #
+                next_queue = new_direction = "up" if next_floor else "idle" #
 
         else:
             next_floor_up = await get_next_floor("up", current_floor)
@@ -191,16 +291,18 @@ async def go_to():
                 floor_down = int(next_floor_down.split("_")[1])
                 if abs(current_floor - floor_up) <= abs(current_floor - floor_down):
                     next_floor = next_floor_up
-                    new_direction = "up"
+                    next_queue = new_direction = "up"
+                    await requeue_floor("down", next_floor_down, floor_down)
                 else:
                     next_floor = next_floor_down
-                    new_direction = "down"
+                    next_queue = new_direction = "down"
+                    await requeue_floor("up", next_floor_up, floor_up)
             elif next_floor_up:
                 next_floor = next_floor_up
-                new_direction = "up"
+                next_queue = new_direction = "up"
             elif next_floor_down:
                 next_floor = next_floor_down
-                new_direction = "down"
+                next_queue = new_direction = "down"
             else:
                 next_floor = None
                 new_direction = "idle"
@@ -210,54 +312,55 @@ async def go_to():
             floor_number = int(next_floor.split("_")[1])
 
 
-            if new_direction == "down":
-                for fl in range(current_floor, floor_number-1, -1):
+            try:
+                # Publish the departure so readers can place the car while it travels
+                travel_time = abs(floor_number - current_floor)
+                if travel_time:
+                    await set_current_position(current_floor, new_direction, floor_number, time.time())
+                logger.info("Moving %s from floor %s to %s", new_direction, current_floor, floor_number)
+                await asyncio.sleep(travel_time) # simulate elevator movement time, one second per floor
                     
-                    await set_current_floor(fl)
-                    await set_current_state({"floor": fl, "state": new_direction})
-
-                    logger.info(f"Moving {new_direction}")
-                    logger.info(f"Current Floor: {fl}")
-                    await asyncio.sleep(1) # simulate elevator movement time
-            elif new_direction == "up":
-                for fl in range(current_floor, floor_number+1):
-                    await set_current_floor(fl)
-                    await set_current_state({"floor": fl, "state": new_direction})
-
-                    logger.info(f"Moving {new_direction}")
-                    logger.info(f"Current Floor: {fl}")
-                    await asyncio.sleep(1) # simulate elevator movement time
-                
-            await set_current_state({"floor": floor_number, "state": new_direction})
-            await set_current_floor(floor_number)
-            logger.info(f"Reached {floor_number}")
+                await set_current_position(floor_number, new_direction)
+            except BaseException:
+                # Failed or cancelled before arriving: put the floor back and
+                # leave the car where it set off from
+                await requeue_floor(next_queue, next_floor, floor_number)
+                await set_current_position(current_floor, current_direction)
+                raise
+            logger.info("Reached %s", floor_number)
 
 
-            intended_direction = await redis_client.hget(f"floor_{floor_number}", "intended_direction")
+            # Read and clear the intended direction in one round trip
+            async with redis_client.pipeline(transaction=False) as pipe:
+                intended_direction, _ = await pipe.hget(f"floor_{floor_number}", "intended_direction").hdel(f"floor_{floor_number}", "intended_direction").execute()
 
             if intended_direction:
-                logger.info(f"Intended direction for floor {floor_number}: {intended_direction.decode()}")
-                await redis_client.hdel(f"floor_{floor_number}", "intended_direction")
+                logger.info("Intended direction for floor %s: %s", floor_number, intended_direction)
                 # Set the elevator's direction to the intended direction
-                new_direction = intended_direction.decode()
+                new_direction = intended_direction
                 await set_current_state({"floor": floor_number, "state": new_direction})
 
             logger.info("Opening door...")
             await asyncio.sleep(2) # simulate door opening time
             logger.info("Closing door...")
+            return True
             
         else:
-            logger.info("No more floors to go to")
-            if once != 1:
+            logger.debug("No more floors to go to")
+            # Check-and-set in one step; a call() resetting the flag during the
+            # write below gets the stop announced again on the next tick
+            async with state_lock:
+                announce = not state.stopped_logged
+                state.stopped_logged = True
+            if announce:
                 logger.info("Stopping elevator...")
-                once = 1
                 await set_current_state({"floor": current_floor, "state": "idle"})
-                logging.info("Stopped elevator")
-                logging.info(f"Current State: {current_state['state']}, Current Floor: {current_floor}")
+                logger.info("Stopped elevator")
+                logger.info("Current State: %s, Current Floor: %s", current_state['state'], current_floor)
             else:
-                logger.info(f"Elevator is at {current_state['state']} state, Current Floor: {current_floor}")
-                await asyncio.sleep(2) # simulate stopping elevator time
+                logger.debug("Elevator is at %s state, Current Floor: %s", current_state['state'], current_floor)
+            return False
         
     except Exception as e:
-        logger.error(f"Error processing go_to request: {str(e)}")
+        logger.exception("Error processing go_to request: %s", e)
         raise e
\ No newline at end of file